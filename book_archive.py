@@ -0,0 +1,329 @@
+"""
+Packed archive of finished books
+
+Reading one page from `gyazo_info.json` needs to parse the whole file.
+The archive stores each page (OCR text and metadata) as a zlib-compressed
+JSON record, with an offset index, so that any page can be read by mmap
+without touching the rest.
+
+Layout (little endian):
+    MAGIC
+    page records            zlib-compressed JSON of each gyazo_info entry
+    page table              (offset, length) as "<QI" for each page
+    book table              zlib-compressed JSON:
+                            [{"book": key, "first_page": i, "num_pages": n}]
+    footer                  "<QQQQ" page table offset, num pages,
+                            book table offset, book table length, then MAGIC
+
+Usage:
+    python book_archive.py out_book240506 out_book240601 -o books.pack
+    python book_archive.py --self-check
+"""
+
+import os
+import argparse
+import json
+import mmap
+import struct
+import tempfile
+import zlib
+from book_dir import is_all_uploaded, is_all_ocr_done
+
+MAGIC = b"FPDFARC1"
+PAGE_ENTRY = struct.Struct("<QI")
+FOOTER = struct.Struct("<QQQQ8s")
+
+
+class BookArchiveWriter:
+    """
+    Writes books into a new archive.
+
+    Use as a context manager, or call `close()` to write the index.
+    The archive is written to `path + ".tmp"` and moved to `path` only when
+    it is complete, so an existing archive is kept until then.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.tmp_path = path + ".tmp"
+        self.f = open(self.tmp_path, "wb")
+        self.f.write(MAGIC)
+        self.page_entries = []
+        self.books = []
+        self.book_keys = set()
+
+    def add_book(self, book, gyazo_info):
+        """
+        Add a book.
+
+        Args:
+        - book (str): The key of the book, unique in the archive.
+        - gyazo_info (list): The pages, as loaded from `gyazo_info.json`.
+        """
+        if book in self.book_keys:
+            raise ValueError(f"Duplicate book: {book}")
+        self.book_keys.add(book)
+        self.books.append(
+            {
+                "book": book,
+                "first_page": len(self.page_entries),
+                "num_pages": len(gyazo_info),
+            }
+        )
+        for page in gyazo_info:
+            data = zlib.compress(json.dumps(page, ensure_ascii=False).encode("utf-8"))
+            self.page_entries.append((self.f.tell(), len(data)))
+            self.f.write(data)
+
+    def close(self):
+        if self.f.closed:
+            return
+        try:
+            self.write_index()
+            self.f.close()
+            os.replace(self.tmp_path, self.path)
+        except BaseException:
+            self.abort()
+            raise
+
+    def write_index(self):
+        page_table_offset = self.f.tell()
+        for offset, length in self.page_entries:
+            self.f.write(PAGE_ENTRY.pack(offset, length))
+        book_table_offset = self.f.tell()
+        data = zlib.compress(json.dumps(self.books, ensure_ascii=False).encode("utf-8"))
+        self.f.write(data)
+        self.f.write(
+            FOOTER.pack(
+                page_table_offset,
+                len(self.page_entries),
+                book_table_offset,
+                len(data),
+                MAGIC,
+            )
+        )
+
+    def abort(self):
+        """
+        Discard the archive being written.
+        """
+        if not self.f.closed:
+            self.f.close()
+        if os.path.exists(self.tmp_path):
+            os.remove(self.tmp_path)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if exc_type is None:
+            self.close()
+        else:
+            self.abort()
+
+
+class BookArchive:
+    """
+    Memory-mapped reader of an archive.
+
+    Only the book table is parsed on open. Each page is decompressed when
+    it is read.
+    """
+
+    def __init__(self, path):
+        if os.path.getsize(path) < len(MAGIC) + FOOTER.size:
+            raise ValueError(f"Not a book archive: {path}")
+        with open(path, "rb") as f:
+            self.mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            self.read_index(path)
+        except BaseException:
+            self.mm.close()
+            raise
+
+    def read_index(self, path):
+        if self.mm[: len(MAGIC)] != MAGIC:
+            raise ValueError(f"Not a book archive: {path}")
+        (
+            self.page_table_offset,
+            self.num_all_pages,
+            book_table_offset,
+            book_table_length,
+            magic,
+        ) = FOOTER.unpack_from(self.mm, len(self.mm) - FOOTER.size)
+        if magic != MAGIC:
+            raise ValueError(f"Broken book archive: {path}")
+        data = self.mm[book_table_offset : book_table_offset + book_table_length]
+        self.book_table = {}
+        for b in json.loads(zlib.decompress(data)):
+            if b["book"] in self.book_table:
+                raise ValueError(f"Duplicate book {b['book']} in {path}")
+            self.book_table[b["book"]] = b
+
+    def books(self):
+        """
+        Returns the keys of the books, in the order they were added.
+        """
+        return list(self.book_table)
+
+    def num_pages(self, book):
+        return self.book_table[book]["num_pages"]
+
+    def page(self, book, index):
+        """
+        Returns a page of the book.
+
+        Args:
+        - book (str): The key of the book.
+        - index (int): The 0-based page index in the book.
+
+        Returns:
+        - dict: The gyazo_info entry of the page.
+        """
+        info = self.book_table[book]
+        if not 0 <= index < info["num_pages"]:
+            raise IndexError(f"Page {index} out of range for {book}")
+        offset, length = PAGE_ENTRY.unpack_from(
+            self.mm,
+            self.page_table_offset + (info["first_page"] + index) * PAGE_ENTRY.size,
+        )
+        return json.loads(zlib.decompress(self.mm[offset : offset + length]))
+
+    def pages(self, book):
+        for i in range(self.num_pages(book)):
+            yield self.page(book, i)
+
+    def ocr_text(self, book, index):
+        return self.page(book, index).get("ocr_text")
+
+    def close(self):
+        self.mm.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def iter_finished_books(out_dir):
+    """
+    Yields (title, gyazo_info) of the finished books in the `out*/` tree.
+
+    A book is finished when all images are uploaded and OCR-ed,
+    by the same checks as `main.py`.
+    """
+    for book in sorted(os.listdir(out_dir)):
+        directory = os.path.join(out_dir, book)
+        json_path = os.path.join(directory, "gyazo_info.json")
+        if not os.path.exists(json_path):
+            continue
+        with open(json_path) as f:
+            gyazo_info = json.load(f)
+        if not is_all_uploaded(directory, gyazo_info):
+            print(f"Skip {directory} because not uploaded all images.")
+            continue
+        if not is_all_ocr_done(gyazo_info):
+            print(f"Skip {directory} because not OCR-ed all images.")
+            continue
+        yield book, gyazo_info
+
+
+def convert_out_dirs(out_dirs, archive_path):
+    """
+    Pack all finished books in the given output directories into an archive.
+
+    The same title may appear in several output directories, so each book
+    is keyed as `<out_dir name>/<title>`, e.g. `out_book1217/foo`.
+
+    Args:
+    - out_dirs (list): Output directories such as `out` or `out_book240506`.
+    - archive_path (str): The path of the archive to write.
+    """
+    names = {}
+    for out_dir in out_dirs:
+        name = os.path.basename(os.path.abspath(out_dir))
+        if name in names:
+            raise ValueError(
+                f"Output directories have the same name: {names[name]}, {out_dir}"
+            )
+        names[name] = out_dir
+
+    with BookArchiveWriter(archive_path) as writer:
+        for name, out_dir in names.items():
+            for book, gyazo_info in iter_finished_books(out_dir):
+                print(f"{name}/{book}")
+                writer.add_book(f"{name}/{book}", gyazo_info)
+
+
+def self_check():
+    """
+    Pack two small trees, and read them back.
+    """
+    with tempfile.TemporaryDirectory() as tmp:
+        expected = {}
+        for out_name, num_books in [("out_a", 2), ("out_b", 1)]:
+            for i in range(num_books):
+                book = f"book{i}"
+                directory = os.path.join(tmp, out_name, book)
+                os.makedirs(directory)
+                gyazo_info = []
+                for j in range(3 + i):
+                    open(os.path.join(directory, f"page-{j + 1}.jpg"), "w").close()
+                    gyazo_info.append(
+                        {"image_id": f"{out_name}-{book}-{j}", "ocr_text": f"本{j}"}
+                    )
+                with open(os.path.join(directory, "gyazo_info.json"), "w") as f:
+                    json.dump(gyazo_info, f, ensure_ascii=False)
+                expected[f"{out_name}/{book}"] = gyazo_info
+
+        archive_path = os.path.join(tmp, "books.pack")
+        out_dirs = [os.path.join(tmp, "out_a"), os.path.join(tmp, "out_b")]
+        convert_out_dirs(out_dirs, archive_path)
+        with BookArchive(archive_path) as archive:
+            assert archive.books() == list(expected)
+            for book, gyazo_info in expected.items():
+                n = archive.num_pages(book)
+                assert n == len(gyazo_info)
+                assert archive.page(book, 0) == gyazo_info[0]
+                assert archive.page(book, n - 1) == gyazo_info[-1]
+                assert list(archive.pages(book)) == gyazo_info
+                for index in [-1, n]:
+                    try:
+                        archive.page(book, index)
+                    except IndexError:
+                        pass
+                    else:
+                        raise AssertionError(f"No IndexError for page {index}")
+
+        empty_path = os.path.join(tmp, "empty.pack")
+        open(empty_path, "w").close()
+        try:
+            BookArchive(empty_path)
+        except ValueError as e:
+            assert "Not a book archive" in str(e)
+        else:
+            raise AssertionError("No ValueError for an empty file")
+    print("OK")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="pack out*/ trees into an archive")
+    parser.add_argument("out_dirs", nargs="*", help="output directories")
+    parser.add_argument(
+        "--out", "-o", type=str, default="books.pack", help="archive path"
+    )
+    parser.add_argument(
+        "--self-check", action="store_true", help="check reading and writing"
+    )
+    args = parser.parse_args()
+    if args.self_check:
+        self_check()
+        return
+    if not args.out_dirs:
+        parser.error("output directories are required")
+    convert_out_dirs(args.out_dirs, args.out)
+
+
+if __name__ == "__main__":
+    main()
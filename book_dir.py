@@ -0,0 +1,29 @@
+"""
+Helpers on a book directory (`out/<pdf name>/`)
+
+Shared by `main.py` and `book_archive.py`. `main.py` parses the command line
+on import, so these live here.
+"""
+
+import os
+
+
+def get_images(directory):
+    return [
+        f for f in os.listdir(directory) if f.endswith(".jpg") or f.endswith(".png")
+    ]
+
+
+def is_all_uploaded(directory, gyazo_info):
+    """
+    Returns True if all images in the directory are uploaded to Gyazo.
+    """
+    return len(gyazo_info) == len(get_images(directory))
+
+
+def is_all_ocr_done(gyazo_info):
+    """
+    Returns True if all pages have OCR text.
+    Pages without OCR from Gyazo have "OCR not available" as the text.
+    """
+    return all("ocr_text" in page for page in gyazo_info)
@@ -9,8 +9,10 @@ import subprocess
 import requests
 import re
 import json
+import hashlib
 from tqdm import tqdm
 from time import sleep, time
+from book_dir import get_images, is_all_uploaded
 
 parser = argparse.ArgumentParser(description="from PDF to Scrapbox")
 parser.add_argument(
@@ -50,6 +52,16 @@ parser.add_argument(
 parser.add_argument(
     "--filter", action="store_true", help="filter PDFs that are alreadt processed"
 )
+parser.add_argument(
+    "--since-last-export",
+    action="store_true",
+    help="Put only new or modified pages into total_scrapbox.json",
+)
+parser.add_argument(
+    "--mark-exported",
+    action="store_true",
+    help="Record the pages of the last --since-last-export as imported",
+)
 
 args = parser.parse_args()
 
@@ -108,12 +120,6 @@ def upload_one_image_to_gyazo(image_name, directory):
         sleep(30)
 
 
-def get_images(directory):
-    return [
-        f for f in os.listdir(directory) if f.endswith(f".jpg") or f.endswith(f".png")
-    ]
-
-
 def run_pdftocairo(input_pdf, output_directory, resolution=200, format="jpeg"):
     """
     Runs pdftocairo on the given input PDF to convert it to specified format.
@@ -242,8 +248,7 @@ def get_ocr_texts(directory):
     with open(json_path) as f:
         gyazo_info = json.load(f)
 
-    image_files = get_images(directory)
-    if len(gyazo_info) != len(image_files):
+    if not is_all_uploaded(directory, gyazo_info):
         print(f"Skip it because not uploaded all images.")
         return
 
@@ -294,22 +299,82 @@ def process_one_pdf(in_file):
     make_scrapbox_json(out_dir)
 
 
+# Bump this when the output of `make_scrapbox_json` changes,
+# so that existing books are regenerated.
+SCRAPBOX_FORMAT_VERSION = 1
+
+
+def file_hash(path):
+    """
+    Returns the SHA-256 hex digest of the file content.
+    """
+    h = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1 << 20), b""):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+def page_hash(page):
+    """
+    Returns the SHA-256 hex digest of a Scrapbox page (title and lines).
+    """
+    data = json.dumps(page, sort_keys=True, ensure_ascii=False)
+    return hashlib.sha256(data.encode("utf-8")).hexdigest()
+
+
+def load_manifest(path):
+    if not os.path.exists(path):
+        return {}
+    with open(path) as f:
+        return json.load(f)
+
+
+def save_manifest(path, manifest):
+    """
+    Write the manifest to a temporary file and rename it,
+    so that a crash never leaves a truncated manifest.
+    """
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "w") as f:
+        json.dump(manifest, f, indent=2, ensure_ascii=False)
+    os.replace(tmp_path, path)
+
+
 def make_scrapbox_json(directory):
     """
     Read `gyazo_info.json` and make Scrapbox JSON.
+
+    `scrapbox_manifest.json` in the output directory records the hash of
+    `gyazo_info.json` and the format version for each book, so that unchanged
+    books are not regenerated.
     """
     json_path = os.path.join(directory, "gyazo_info.json")
     if not os.path.exists(json_path):
         print(f"Skip it because gyazo_info.json not exists.")
         return
+
+    out_path = os.path.join(directory, "scrapbox.json")
+    manifest_path = os.path.join(args.out_dir, "scrapbox_manifest.json")
+    gyazo_info_hash = file_hash(json_path)
+    title = os.path.split(directory)[-1]
+    book_manifest = {
+        "gyazo_info_sha256": gyazo_info_hash,
+        "format_version": SCRAPBOX_FORMAT_VERSION,
+    }
+    if (
+        os.path.exists(out_path)
+        and load_manifest(manifest_path).get(title) == book_manifest
+    ):
+        print(f"Skip {directory} because gyazo_info.json not changed.")
+        return
+
     with open(json_path) as f:
         gyazo_info = json.load(f)
 
     print(f"Making Scrapbox JSON for {directory}...")
-    title = os.path.split(directory)[-1]
 
-    image_files = get_images(directory)
-    if len(gyazo_info) != len(image_files):
+    if not is_all_uploaded(directory, gyazo_info):
         print(f"Skip it because not uploaded all images.")
         return
 
@@ -346,10 +411,14 @@ def make_scrapbox_json(directory):
     scrapbox_json = {"pages": scrapbox_pages}
 
     # Save the JSON
-    out_path = os.path.join(directory, "scrapbox.json")
     with open(out_path, "w") as f:
         json.dump(scrapbox_json, f, indent=2, ensure_ascii=False)
 
+    # Save the manifest after the JSON, so that a crash leaves it stale
+    manifest = load_manifest(manifest_path)
+    manifest[title] = book_manifest
+    save_manifest(manifest_path, manifest)
+
 
 def get_pdfs_in_dir():
     # Get all PDF files in the input directory
@@ -445,6 +514,19 @@ def recovery():
 
 
 def make_total_scrapbox_json(targets):
+    """
+    Concatenate `scrapbox.json` of the targets into `total_scrapbox.json`.
+
+    With `--since-last-export`, pages whose hash is the same as in
+    `total_scrapbox_manifest.json` are left out. The hashes of the written
+    pages are kept in `total_scrapbox_pending.json`, and recorded in the
+    manifest only by `--mark-exported` after the import succeeded. Until
+    then, the pages are written again by every `--since-last-export` run.
+    Runs without the option write all pages and touch neither file.
+    """
+    manifest_path = os.path.join(args.out_dir, "total_scrapbox_manifest.json")
+    exported = load_manifest(manifest_path)
+    pending = {}
     total_pages = []
     data = {"pages": total_pages}
     for target in targets:
@@ -453,9 +535,36 @@ def make_total_scrapbox_json(targets):
             continue
         with open(json_path) as f:
             pages = json.load(f)["pages"]
-            total_pages.extend(pages)
+        for page in pages:
+            h = page_hash(page)
+            if args.since_last_export and exported.get(page["title"]) == h:
+                continue
+            pending[page["title"]] = h
+            total_pages.append(page)
+    print(f"Num pages to export: {len(total_pages)}")
     with open(os.path.join(args.out_dir, "total_scrapbox.json"), "w") as f:
         json.dump(data, f, indent=2)
+    if args.since_last_export:
+        pending_path = os.path.join(args.out_dir, "total_scrapbox_pending.json")
+        save_manifest(pending_path, pending)
+
+
+def mark_exported():
+    """
+    Record the pages of the last `--since-last-export` as exported,
+    after `total_scrapbox.json` is imported to Scrapbox.
+    """
+    manifest_path = os.path.join(args.out_dir, "total_scrapbox_manifest.json")
+    pending_path = os.path.join(args.out_dir, "total_scrapbox_pending.json")
+    if not os.path.exists(pending_path):
+        print("Nothing to mark because total_scrapbox_pending.json not exists.")
+        return
+    exported = load_manifest(manifest_path)
+    pending = load_manifest(pending_path)
+    exported.update(pending)
+    save_manifest(manifest_path, exported)
+    os.remove(pending_path)
+    print(f"Marked {len(pending)} pages as exported.")
 
 
 def filter():
@@ -491,6 +600,9 @@ def main():
     if args.filter:
         filter()
         return
+    if args.mark_exported:
+        mark_exported()
+        return
     if args.recovery:
         recovery()
         return